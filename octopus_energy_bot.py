@@ -4,25 +4,40 @@ from discord import app_commands
 from discord.ext import commands
 import asyncio
 import aiohttp
-from sqlalchemy import create_engine, Column, Integer, String, DateTime
-from sqlalchemy.orm import declarative_base, sessionmaker
+import httpx
+from sqlalchemy import bindparam, event, select, Column, Integer, String, DateTime
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import declarative_base
 from datetime import datetime, timedelta
-import matplotlib.pyplot as plt
+import matplotlib
+matplotlib.use('Agg')  # Headless raster backend; must be set before seaborn imports pyplot
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 import seaborn as sns
 import io
 from dotenv import load_dotenv
 import os
+import sys
 from gql import gql, Client
 from gql.transport.aiohttp import AIOHTTPTransport
-from gql.transport.exceptions import TransportQueryError
+from gql.transport.exceptions import TransportQueryError, TransportServerError
 import logging
 from cachetools import TTLCache
-from aiohttp import ClientTimeout
 import pytz
 import backoff
 from asyncio import TimeoutError
 import pandas as pd
+import numpy as np
 from dataclasses import dataclass
+from functools import lru_cache
+import base64
+import hashlib
+import json
+import orjson
+import threading
+import time
 
 # Set up logging
 logging.basicConfig(
@@ -31,6 +46,9 @@ logging.basicConfig(
     handlers=[logging.StreamHandler()]
 )
 logger = logging.getLogger(__name__)
+# httpx logs every request URL at INFO, which includes users' meter identifiers
+logging.getLogger('httpx').setLevel(logging.WARNING)
+logging.getLogger('httpcore').setLevel(logging.WARNING)
 
 # Load environment variables
 load_dotenv()
@@ -43,9 +61,33 @@ API_TIMEOUT = 60
 MAX_RETRIES = 3
 BACKOFF_MAX_TIME = 120
 CACHE_TTL = 3600  # 1 hour cache TTL
+CHART_DPI = 100  # Discord scales images to fit anyway, so higher DPI only adds pixels
+MAX_CHART_MARKERS = 30  # Longer series draw a marker only every Nth point
+HTTP_POOL_LIMIT = 100
+HTTP_KEEPALIVE_CONNECTIONS = 20
+HTTP_KEEPALIVE_TIMEOUT = 60
+GRAPHQL_KEEPALIVE_TIMEOUT = 75
+DNS_CACHE_TTL = 300
+MAX_CONCURRENT_METER_POINTS = 8
+GAS_KWH_PER_M3 = 39.5 * 1.02264 / 3.6  # Calorific value x volume correction / MJ per kWh
+TOKEN_EXPIRY_MARGIN = 60  # Re-mint Kraken tokens this many seconds before expiry
+TOKEN_CACHE_TTL = 3000  # Upper bound on holding a token, below Kraken's 1 hour lifetime
+ACCOUNT_CACHE_TTL = 86400  # Meter points and product codes rarely change intra-day
 
 # Initialize cache
 response_cache = TTLCache(maxsize=100, ttl=CACHE_TTL)
+# Unit rates and standing charges are per product, so they are shared across users
+tariff_cache = TTLCache(maxsize=512, ttl=CACHE_TTL)
+# Tariff fetches currently in flight by cache key
+inflight_requests = {}
+# Kraken JWTs by hashed API key: (token, expiry timestamp)
+token_cache = TTLCache(maxsize=1000, ttl=TOKEN_CACHE_TTL)
+# Minting locks by hashed API key; bounded like the tokens so they don't pile up
+token_locks = TTLCache(maxsize=1000, ttl=TOKEN_CACHE_TTL)
+# Account info by (hashed API key, account number)
+account_cache = TTLCache(maxsize=1000, ttl=ACCOUNT_CACHE_TTL)
+# Rendered replies by (discord id, energy type, time period, end date): (summary, [(filename, png bytes)])
+chart_cache = TTLCache(maxsize=200, ttl=CACHE_TTL)
 
 # Database models
 Base = declarative_base()
@@ -53,27 +95,158 @@ Base = declarative_base()
 class User(Base):
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True)
-    discord_id = Column(String, unique=True)
+    discord_id = Column(String, unique=True, index=True)
     api_key = Column(String)
     account_number = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
     last_updated = Column(DateTime, onupdate=datetime.utcnow)
 
-# Initialize database
-engine = create_engine(DATABASE_URL)
-Base.metadata.create_all(engine)
-Session = sessionmaker(bind=engine)
+class BotSetting(Base):
+    __tablename__ = 'bot_settings'
+    key = Column(String, primary_key=True)
+    value = Column(String)
+
+# Initialize database (tables are created in setup_hook)
+# Sync driver URLs from existing .env files are mapped to their async equivalents
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'sqlite+pysqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+    'postgresql+psycopg2': 'postgresql+asyncpg',
+    'mysql': 'mysql+aiomysql',
+    'mysql+pymysql': 'mysql+aiomysql',
+    'mysql+mysqldb': 'mysql+aiomysql',
+}
+
+database_url = make_url(DATABASE_URL)
+if database_url.drivername in ASYNC_DRIVERS:
+    database_url = database_url.set(drivername=ASYNC_DRIVERS[database_url.drivername])
+
+if database_url.get_backend_name() == 'sqlite':
+    engine = create_async_engine(
+        database_url,
+        connect_args={"timeout": 30}
+    )
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+else:
+    try:
+        engine = create_async_engine(database_url)
+    except InvalidRequestError as e:
+        raise ValueError(
+            f"DATABASE_URL uses the synchronous driver '{database_url.drivername}'; "
+            "use an async driver URL such as postgresql+asyncpg:// or mysql+aiomysql://"
+        ) from e
+Session = async_sessionmaker(engine, expire_on_commit=False)
+
+# Built once so each lookup reuses the same statement (and its cached compilation)
+# instead of constructing a new select; discord_id is indexed
+user_credentials_query = select(User.api_key, User.account_number).where(
+    User.discord_id == bindparam('discord_id')
+)
+
+async def get_setting(key: str):
+    async with Session() as session:
+        setting = await session.get(BotSetting, key)
+        return setting.value if setting else None
+
+async def set_setting(key: str, value: str):
+    async with Session() as session:
+        await session.merge(BotSetting(key=key, value=value))
+        await session.commit()
+
+def orjson_dumps(obj) -> str:
+    # aiohttp expects serialisers to return str
+    return orjson.dumps(obj).decode()
 
 # Bot setup
+class OctoBot(commands.Bot):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.http_client = None
+        self.gql_connector = None
+        self.gql_client = None
+        self.gql_session = None
+
+    async def setup_hook(self):
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+
+        # One pooled HTTP/2 client for the lifetime of the bot, so concurrent
+        # REST calls are multiplexed over a single keep-alive TLS connection
+        self.http_client = httpx.AsyncClient(
+            http2=True,
+            timeout=httpx.Timeout(
+                API_TIMEOUT,  # Default timeout
+                connect=10,   # Connection timeout
+                read=30       # Socket read timeout
+            ),
+            limits=httpx.Limits(
+                max_connections=HTTP_POOL_LIMIT,
+                max_keepalive_connections=HTTP_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=HTTP_KEEPALIVE_TIMEOUT
+            )
+        )
+
+        # Long-lived GraphQL session; the queries are static so the schema
+        # introspection round trip is skipped
+        # The transport opens its aiohttp session on connect; give it a connector
+        # we own so pooled connections and DNS entries survive gql reconnects
+        self.gql_connector = aiohttp.TCPConnector(
+            limit_per_host=HTTP_KEEPALIVE_CONNECTIONS,
+            keepalive_timeout=GRAPHQL_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=DNS_CACHE_TTL
+        )
+        self.gql_client = Client(
+            transport=AIOHTTPTransport(
+                url=APIEndpoints.GRAPHQL,
+                timeout=30,
+                json_serialize=orjson_dumps,
+                json_deserialize=orjson.loads,
+                client_session_args={
+                    'connector': self.gql_connector,
+                    'connector_owner': False
+                }
+            ),
+            fetch_schema_from_transport=False,
+            execute_timeout=30
+        )
+        self.gql_session = await self.gql_client.connect_async(reconnecting=True)
+
+    async def close(self):
+        await super().close()
+        # Close our connector first; with connector_owner=False gql leaves it open
+        if self.gql_connector:
+            await self.gql_connector.close()
+        if self.gql_client:
+            await self.gql_client.close_async()
+        if self.http_client:
+            await self.http_client.aclose()
+        await engine.dispose()
+
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix='!', intents=intents)
+bot = OctoBot(command_prefix='!', intents=intents)
 
 # API endpoints
 class APIEndpoints:
     GRAPHQL = "https://api.octopus.energy/v1/graphql/"
     REST = "https://api.octopus.energy/v1/"
 
+# Fuel type to tariff code letter, e.g. E-1R-<product>-E
+TARIFF_CODE = {'electricity': 'E', 'gas': 'G'}
+
+@lru_cache(maxsize=256)
+def tariff_url(fuel_type: str, product_code: str, kind: str) -> str:
+    tariff_code = TARIFF_CODE[fuel_type]
+    return f"{APIEndpoints.REST}products/{product_code}/{fuel_type}-tariffs/{tariff_code}-1R-{product_code}-{tariff_code}/{kind}/"
+
 # GraphQL queries
 class GraphQLQueries:
     OBTAIN_TOKEN = gql("""
@@ -130,35 +303,53 @@ class GraphQLQueries:
     }
     """)
 
+async def single_flight(key, fetch):
+    # Concurrent callers with the same key await one shared fetch
+    task = inflight_requests.get(key)
+    if task is None:
+        task = asyncio.ensure_future(fetch())
+        inflight_requests[key] = task
+        task.add_done_callback(lambda _: inflight_requests.pop(key, None))
+    # Shield so one caller being cancelled doesn't cancel the fetch for the rest
+    return await asyncio.shield(task)
+
 @dataclass
 class EnergyData:
     fuel_type: str
+    dates: list  # Reading dates, parallel to consumption
     consumption: list
     tariff: list
     standing_charge: float
     summary: str
 
+class AuthError(ValueError):
+    """The Octopus Energy API rejected a Kraken token."""
+
+def invalidate_token(token_key: str, token: str):
+    # Only drop the cached token if it is still the one that was rejected
+    if token_cache.get(token_key, (None, 0))[0] == token:
+        token_cache.pop(token_key, None)
+
 class APIClient:
-    def __init__(self, token: str):
+    def __init__(self, http_client: httpx.AsyncClient, token: str, token_key: str):
+        self.http_client = http_client
         self.token = token
-        self.timeout = ClientTimeout(
-            total=60,      # Total timeout
-            connect=10,    # Connection timeout
-            sock_read=30   # Socket read timeout
-        )
-        self.session = None
-
-    async def __aenter__(self):
-        self.session = aiohttp.ClientSession(timeout=self.timeout)
-        return self
+        self.token_key = token_key
+        # Same headers for every request this client makes, so build them once
+        self.headers = {
+            'Authorization': f'JWT {token}',
+            'Accept': 'application/json'
+        }
 
-    async def __aexit__(self, exc_type, exc_val, exc_tb):
-        if self.session:
-            await self.session.close()
+    def check_auth(self, response: httpx.Response):
+        if response.status_code in (401, 403):
+            # The token was revoked before its exp claim; make the next command mint a new one
+            invalidate_token(self.token_key, self.token)
+            raise AuthError("Your Octopus Energy session has expired. Please try again.")
 
     @backoff.on_exception(
         backoff.expo,
-        (TimeoutError, TransportQueryError, aiohttp.ClientError),
+        (TimeoutError, TransportQueryError, httpx.HTTPError),
         max_tries=3,
         max_time=30
     )
@@ -171,117 +362,151 @@ class APIClient:
         params = {
             'period_from': from_date.isoformat(),
             'period_to': to_date.isoformat(),
-            'group_by': 'day'
-        }
-        headers = {
-            'Authorization': f'JWT {self.token}',
-            'Accept': 'application/json'
+            'group_by': 'day',
+            # One daily row per day in the period, so everything fits in a single page
+            'page_size': (to_date - from_date).days + 1
         }
         
         try:
-            async with self.session.get(url, params=params, headers=headers) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    results = data.get('results', [])
+            response = await self.http_client.get(url, params=params, headers=self.headers)
+            self.check_auth(response)
+            if response.status_code == 200:
+                data = orjson.loads(response.content)
+                results = data.get('results', [])
                     
-                    if results:
-                        # Sort results by date
-                        results.sort(key=lambda x: x['interval_start'])
+                if results:
+                    # Sort results by date
+                    results.sort(key=lambda x: x['interval_start'])
+
+                    # Parse dates before caching so cache hits don't parse them again
+                    for day in results:
+                        day['_date'] = datetime.fromisoformat(day['interval_start']).date()
                         
-                        # Find the latest data point
-                        latest_reading = results[-1]
-                        latest_date = datetime.fromisoformat(latest_reading['interval_start'])
-                        current_time = datetime.now(pytz.UTC)
-                        delay = current_time - latest_date
+                    # Find the latest data point
+                    latest_reading = results[-1]
+                    latest_date = datetime.fromisoformat(latest_reading['interval_start'])
+                    current_time = datetime.now(pytz.UTC)
+                    delay = current_time - latest_date
                         
-                        logger.info(f"\n{fuel_type.capitalize()} Data Status:")
-                        logger.info(f"Latest reading: {latest_date.strftime('%Y-%m-%d %H:%M:%S %Z')}")
-                        logger.info(f"Current time: {current_time.strftime('%Y-%m-%d %H:%M:%S %Z')}")
-                        logger.info(f"Data delay: {delay.days} days, {delay.seconds//3600} hours")
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(f"\n{fuel_type.capitalize()} Data Status:")
+                        logger.debug(f"Latest reading: {latest_date.strftime('%Y-%m-%d %H:%M:%S %Z')}")
+                        logger.debug(f"Current time: {current_time.strftime('%Y-%m-%d %H:%M:%S %Z')}")
+                        logger.debug(f"Data delay: {delay.days} days, {delay.seconds//3600} hours")
                         
-                        if delay.days >= 2:
-                            logger.warning(f"Data is more than 48 hours old. This might indicate an issue with meter readings.")
+                    if delay.days >= 2:
+                        logger.warning(f"Data is more than 48 hours old. This might indicate an issue with meter readings.")
                     
-                    response_cache[cache_key] = results
-                    return results
+                response_cache[cache_key] = results
+                return results
                     
-        except aiohttp.ClientError as e:
+        except httpx.HTTPError as e:
             logger.error(f"API request failed: {str(e)}")
             raise
 
     async def get_tariff_data(self, fuel_type, product_code, from_date, to_date):
-        url = f"{APIEndpoints.REST}products/{product_code}/{fuel_type}-tariffs/{'G' if fuel_type == 'gas' else 'E'}-1R-{product_code}-{'G' if fuel_type == 'gas' else 'E'}/standard-unit-rates/"
+        cache_key = ('rates', fuel_type, product_code, from_date.date(), to_date.date())
+        if cache_key in tariff_cache:
+            return tariff_cache[cache_key]
+        return await single_flight(
+            cache_key,
+            lambda: self._fetch_tariff_data(cache_key, fuel_type, product_code, from_date, to_date)
+        )
+
+    async def _fetch_tariff_data(self, cache_key, fuel_type, product_code, from_date, to_date):
+        url = tariff_url(fuel_type, product_code, 'standard-unit-rates')
         params = {
             'period_from': from_date.isoformat(),
             'period_to': to_date.isoformat()
         }
-        headers = {
-            'Authorization': f'JWT {self.token}',
-            'Accept': 'application/json'
-        }
 
-        async with self.session.get(url, params=params, headers=headers) as response:
-            response.raise_for_status()
-            data = await response.json()
-            return data['results']
+        response = await self.http_client.get(url, params=params, headers=self.headers)
+        self.check_auth(response)
+        response.raise_for_status()
+        data = orjson.loads(response.content)
+        tariff_cache[cache_key] = data['results']
+        return data['results']
 
     async def get_standing_charge(self, fuel_type, product_code, from_date, to_date):
-        url = f"{APIEndpoints.REST}products/{product_code}/{fuel_type}-tariffs/{'G' if fuel_type == 'gas' else 'E'}-1R-{product_code}-{'G' if fuel_type == 'gas' else 'E'}/standing-charges/"
+        cache_key = ('standing', fuel_type, product_code, from_date.date(), to_date.date())
+        if cache_key in tariff_cache:
+            return tariff_cache[cache_key]
+        return await single_flight(
+            cache_key,
+            lambda: self._fetch_standing_charge(cache_key, fuel_type, product_code, from_date, to_date)
+        )
+
+    async def _fetch_standing_charge(self, cache_key, fuel_type, product_code, from_date, to_date):
+        url = tariff_url(fuel_type, product_code, 'standing-charges')
         params = {
             'period_from': from_date.isoformat(),
             'period_to': to_date.isoformat()
         }
-        headers = {
-            'Authorization': f'JWT {self.token}',
-            'Accept': 'application/json'
-        }
 
-        async with self.session.get(url, params=params, headers=headers) as response:
-            response.raise_for_status()
-            data = await response.json()
-            return data['results'][0]['value_inc_vat'] / 100
+        response = await self.http_client.get(url, params=params, headers=self.headers)
+        self.check_auth(response)
+        response.raise_for_status()
+        data = orjson.loads(response.content)
+        standing_charge = data['results'][0]['value_inc_vat'] / 100
+        tariff_cache[cache_key] = standing_charge
+        return standing_charge
 
-async def get_auth_token(api_key: str) -> str:
-    transport = AIOHTTPTransport(
-        url=APIEndpoints.GRAPHQL,
-        timeout=30
-    )
-    
+async def get_auth_token(session, api_key: str) -> str:
     try:
-        async with Client(
-            transport=transport,
-            fetch_schema_from_transport=True,
-            execute_timeout=30
-        ) as session:
-            result = await session.execute(
-                GraphQLQueries.OBTAIN_TOKEN,
-                variable_values={"input": {"APIKey": api_key}}
-            )
-            return result['obtainKrakenToken']['token']
+        result = await session.execute(
+            GraphQLQueries.OBTAIN_TOKEN,
+            variable_values={"input": {"APIKey": api_key}}
+        )
+        return result['obtainKrakenToken']['token']
     except Exception as e:
         logger.error(f"Failed to get auth token: {str(e)}")
         raise ValueError("Failed to authenticate with Octopus Energy API")
 
-async def get_account_info(token: str, account_number: str):
-    transport = AIOHTTPTransport(
-        url=APIEndpoints.GRAPHQL,
-        headers={'Authorization': f'JWT {token}'},
-        timeout=30
-    )
-    
+def get_token_expiry(token: str) -> float:
+    payload = token.split('.')[1]
+    claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+    return float(claims['exp'])
+
+def hash_api_key(api_key: str) -> str:
+    # Avoid keeping raw API keys as in-memory cache keys
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+async def get_cached_auth_token(session, api_key: str) -> str:
+    key = hash_api_key(api_key)
+    token, expiry = token_cache.get(key, (None, 0))
+    if expiry - time.time() > TOKEN_EXPIRY_MARGIN:
+        return token
+
+    # Serialise minting per key so concurrent commands share one mutation
+    async with token_locks.setdefault(key, asyncio.Lock()):
+        token, expiry = token_cache.get(key, (None, 0))
+        if expiry - time.time() > TOKEN_EXPIRY_MARGIN:
+            return token
+
+        token = await get_auth_token(session, api_key)
+        try:
+            token_cache[key] = (token, get_token_expiry(token))
+        except (IndexError, KeyError, ValueError) as e:
+            logger.warning(f"Could not read auth token expiry, not caching it: {str(e)}")
+        return token
+
+async def get_account_info(session, token: str, account_number: str):
     try:
-        async with Client(
-            transport=transport,
-            fetch_schema_from_transport=True,
-            execute_timeout=30
-        ) as session:
-            result = await session.execute(
-                GraphQLQueries.ACCOUNT_INFO,
-                variable_values={"accountNumber": account_number}
-            )
-            if not result.get('account'):
-                raise ValueError("Account not found")
-            return result['account']
+        # The JWT is per user, so send it per request on the shared session
+        result = await session.execute(
+            GraphQLQueries.ACCOUNT_INFO,
+            variable_values={"accountNumber": account_number},
+            extra_args={'headers': {'Authorization': f'JWT {token}'}}
+        )
+        if not result.get('account'):
+            raise ValueError("Account not found")
+        return result['account']
+    except (TransportQueryError, TransportServerError) as e:
+        if isinstance(e, TransportServerError) and e.code not in (401, 403):
+            logger.error(f"Failed to get account info: {str(e)}")
+            raise ValueError("Failed to retrieve account information")
+        logger.warning(f"Account info request rejected the auth token: {str(e)}")
+        raise AuthError("Failed to retrieve account information")
     except Exception as e:
         logger.error(f"Failed to get account info: {str(e)}")
         raise ValueError("Failed to retrieve account information")
@@ -292,14 +517,20 @@ async def process_meter_point(client: APIClient, fuel_type: str, meter_point: di
         serial_number = meter_point['meters'][0]['serialNumber']
         product_code = meter_point['agreements'][0]['tariff']['productCode']
 
-        consumption_data = await client.get_consumption_data(fuel_type, identifier, serial_number, from_date, to_date)
-        tariff_data = await client.get_tariff_data(fuel_type, product_code, from_date, to_date)
-        standing_charge = await client.get_standing_charge(fuel_type, product_code, from_date, to_date)
+        # Independent GETs to the same host, run concurrently over the shared pool
+        consumption_data, tariff_data, standing_charge = await asyncio.gather(
+            client.get_consumption_data(fuel_type, identifier, serial_number, from_date, to_date),
+            client.get_tariff_data(fuel_type, product_code, from_date, to_date),
+            client.get_standing_charge(fuel_type, product_code, from_date, to_date)
+        )
 
         if consumption_data and tariff_data and standing_charge is not None:
-            summary = calculate_summary(fuel_type, consumption_data, tariff_data, standing_charge, from_date, to_date)
+            # Dates were parsed when the readings were fetched
+            dates = [day['_date'] for day in consumption_data]
+            summary = calculate_summary(fuel_type, dates, consumption_data, tariff_data, standing_charge, from_date, to_date)
             return EnergyData(
                 fuel_type=fuel_type,
+                dates=dates,
                 consumption=consumption_data,
                 tariff=tariff_data,
                 standing_charge=standing_charge,
@@ -309,46 +540,40 @@ async def process_meter_point(client: APIClient, fuel_type: str, meter_point: di
         logger.error(f"Error processing {fuel_type} meter point: {str(e)}")
         raise
 
-def calculate_summary(fuel_type: str, consumption_data: list, tariff_data: list, standing_charge: float, from_date: datetime, to_date: datetime) -> str:
-    total_cost = 0
-    total_consumption = 0
+def calculate_summary(fuel_type: str, dates: list, consumption_data: list, tariff_data: list, standing_charge: float, from_date: datetime, to_date: datetime) -> str:
     total_days = (to_date - from_date).days
 
-    logger.info(f"\nProcessing {fuel_type} data for {total_days} days")
+    logger.debug("Processing %s data for %d days", fuel_type, total_days)
 
-    for day in consumption_data:
-        date = datetime.fromisoformat(day['interval_start']).date()
-        raw_consumption = day['consumption']
-        
-        if fuel_type == 'gas':
-            # Detailed gas conversion logging
-            logger.info(f"\nGas conversion for {date}:")
-            logger.info(f"Raw gas value: {raw_consumption} m³")
-            
-            # Convert m³ to kWh using the formula
-            kwh_conversion = raw_consumption * 39.5  # Volume correction factor
-            logger.info(f"After volume correction: {kwh_conversion}")
-            
-            kwh_conversion = kwh_conversion * 1.02264  # Pressure correction
-            logger.info(f"After pressure correction: {kwh_conversion}")
-            
-            consumption = kwh_conversion / 3.6  # Final conversion to kWh
-            logger.info(f"Final kWh value: {consumption}")
-        else:
-            consumption = raw_consumption
+    dates = np.array(dates, dtype='datetime64[D]')
+    consumption = np.fromiter(
+        (day['consumption'] for day in consumption_data),
+        dtype=np.float64,
+        count=len(consumption_data)
+    )
 
-        total_consumption += consumption
-        
-        applicable_rate = next(
-            (rate for rate in tariff_data if datetime.fromisoformat(rate['valid_from']).date() <= date),
-            None
-        )
-        
-        if applicable_rate:
-            rate = applicable_rate['value_inc_vat'] / 100
-            cost = consumption * rate
-            total_cost += cost
-            logger.info(f"{fuel_type} cost for {date}: £{cost:.2f} (rate: {rate:.4f})")
+    if fuel_type == 'gas':
+        # Convert m³ to kWh
+        consumption *= GAS_KWH_PER_M3
+
+    # Look up the latest tariff starting on or before each day
+    rates = np.zeros(len(consumption_data))
+    if tariff_data:
+        # ISO timestamps start with YYYY-MM-DD, so slicing gives the date
+        tariff_starts = np.array([rate['valid_from'][:10] for rate in tariff_data], dtype='datetime64[D]')
+        tariff_values = np.fromiter(
+            (rate['value_inc_vat'] for rate in tariff_data),
+            dtype=np.float64,
+            count=len(tariff_data)
+        ) / 100
+        # Sort on the full timestamp so the last row for a date is that day's latest rate
+        order = np.argsort([rate['valid_from'] for rate in tariff_data], kind='stable')
+        idx = np.searchsorted(tariff_starts[order], dates, side='right') - 1
+        has_rate = idx >= 0
+        rates[has_rate] = tariff_values[order][idx[has_rate]]
+
+    total_consumption = float(consumption.sum())
+    total_cost = float(np.dot(consumption, rates))
 
     total_standing_charge = standing_charge * total_days
     total_cost += total_standing_charge
@@ -360,8 +585,7 @@ def calculate_summary(fuel_type: str, consumption_data: list, tariff_data: list,
         f"Total {fuel_type} cost: £{total_cost:.2f}"
     )
     
-    logger.info(f"\nFinal {fuel_type} Summary:")
-    logger.info(summary)
+    logger.debug("Final %s summary:\n%s", fuel_type, summary)
     
     return summary
 
@@ -393,15 +617,22 @@ class SetupModal(discord.ui.Modal, title="Set Up Octopus Energy Account"):
                 )
                 return
 
-            session = Session()
             try:
-                user = session.query(User).filter_by(discord_id=str(interaction.user.id)).first()
-                if not user:
-                    user = User(discord_id=str(interaction.user.id))
-                    session.add(user)
-                user.api_key = self.api_key.value
-                user.account_number = self.account_number.value
-                session.commit()
+                # Commits on success and rolls back on error
+                async with Session.begin() as session:
+                    result = await session.execute(
+                        select(User).where(User.discord_id == str(interaction.user.id))
+                    )
+                    user = result.scalar_one_or_none()
+                    if not user:
+                        user = User(discord_id=str(interaction.user.id))
+                        session.add(user)
+                    user.api_key = self.api_key.value
+                    user.account_number = self.account_number.value
+
+                # Cached replies were built from the old account details
+                for key in [key for key in chart_cache if key[0] == str(interaction.user.id)]:
+                    chart_cache.pop(key, None)
                 
                 await interaction.response.send_message(
                     "✅ Your Octopus Energy account has been set up successfully!",
@@ -409,13 +640,10 @@ class SetupModal(discord.ui.Modal, title="Set Up Octopus Energy Account"):
                 )
             except Exception as e:
                 logger.error(f"Database error during setup: {str(e)}")
-                session.rollback()
                 await interaction.response.send_message(
                     "❌ An error occurred while saving your account details.",
                     ephemeral=True
                 )
-            finally:
-                session.close()
 
         except Exception as e:
             logger.error(f"Setup error: {str(e)}")
@@ -482,83 +710,97 @@ class SetupChoiceView(discord.ui.View):
     ):
         await interaction.response.send_modal(SetupModal())
 
+def get_chart_series(data: EnergyData, today) -> tuple:
+    # Consumption is already sorted by date; just filter out today
+    points = [
+        (date, day['consumption'])
+        for date, day in zip(data.dates, data.consumption)
+        if date < today
+    ]
+    dates = [date for date, _ in points]
+    values = [value for _, value in points]
+    return dates, values
+
+def marker_step(count: int) -> int:
+    # Markers dominate render time on long series, so thin them out
+    return max(1, count // MAX_CHART_MARKERS)
+
+# Set style once; figures pick it up when they are created
+sns.set_style("whitegrid")
+
+# Each chart type reuses one figure between renders. Charts are drawn from
+# worker threads, so access to each figure is serialised with its own lock.
+chart_figure = Figure(figsize=(12, 6))
+FigureCanvasAgg(chart_figure)
+chart_axes = chart_figure.subplots()
+chart_lock = threading.Lock()
+
+combined_chart_figure = Figure(figsize=(12, 10))
+FigureCanvasAgg(combined_chart_figure)
+combined_chart_axes = combined_chart_figure.subplots(2, 1)
+combined_chart_lock = threading.Lock()
+
 def generate_chart(data: EnergyData) -> io.BytesIO:
-    # Sort data by date and filter out today
-    today = datetime.now(pytz.UTC).date()
-    consumption_data = sorted(
-        [d for d in data.consumption if datetime.fromisoformat(d['interval_start']).date() < today],
-        key=lambda x: x['interval_start']
-    )
-    
-    dates = [datetime.fromisoformat(day['interval_start']).date() for day in consumption_data]
-    values = [day['consumption'] for day in consumption_data]
-    
-    # Set style
-    sns.set_style("whitegrid")
-    
-    plt.figure(figsize=(12, 6))
-    plt.plot(dates, values, marker='o')
+    dates, values = get_chart_series(data, datetime.now(pytz.UTC).date())
     
-    # Use appropriate units based on fuel type
-    units = "m³" if data.fuel_type == "gas" else "kWh"
-    plt.title(f'{data.fuel_type.capitalize()} Consumption')
-    plt.xlabel('Date')
-    plt.ylabel(f'Consumption ({units})')
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-
     buf = io.BytesIO()
-    plt.savefig(buf, format='png', dpi=300, bbox_inches='tight')
-    plt.close()
+    with chart_lock:
+        ax = chart_axes
+        ax.clear()
+        ax.plot(dates, values, marker='o', markevery=marker_step(len(dates)))
+        
+        # Use appropriate units based on fuel type
+        units = "m³" if data.fuel_type == "gas" else "kWh"
+        ax.set_title(f'{data.fuel_type.capitalize()} Consumption')
+        ax.set_xlabel('Date')
+        ax.set_ylabel(f'Consumption ({units})')
+        ax.tick_params(axis='x', rotation=45)
+        chart_figure.tight_layout()
+
+        # Fast zlib level: the PNG is uploaded once, so encode time matters more than size
+        chart_figure.savefig(buf, format='png', dpi=CHART_DPI, bbox_inches='tight', pil_kwargs={'compress_level': 1})
     buf.seek(0)
     return buf
 
 def generate_combined_chart(energy_data_list: list) -> io.BytesIO:
-    sns.set_style("whitegrid")
-    
-    fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(12, 10))
-    
     colors = {
         'electricity': '#007bff',  # Blue
         'gas': '#ff7f0e'          # Orange
     }
     
-    for data in energy_data_list:
-        # Sort data by date and filter out today
+    buf = io.BytesIO()
+    with combined_chart_lock:
+        ax1, ax2 = combined_chart_axes
+        ax1.clear()
+        ax2.clear()
+
         today = datetime.now(pytz.UTC).date()
-        consumption_data = sorted(
-            [d for d in data.consumption if datetime.fromisoformat(d['interval_start']).date() < today],
-            key=lambda x: x['interval_start']
-        )
-        
-        if consumption_data:
-            dates = [datetime.fromisoformat(day['interval_start']).date() for day in consumption_data]
-            values = [day['consumption'] for day in consumption_data]
+        for data in energy_data_list:
+            dates, values = get_chart_series(data, today)
             
-            if data.fuel_type == 'electricity':
-                ax1.plot(dates, values, marker='o', color=colors[data.fuel_type], 
-                        label=f'{data.fuel_type.capitalize()}')
-                ax1.set_ylabel('Electricity Consumption (kWh)')
-            else:
-                ax2.plot(dates, values, marker='o', color=colors[data.fuel_type], 
-                        label=f'{data.fuel_type.capitalize()}')
-                ax2.set_ylabel('Gas Consumption (m³)')
-    
-    ax1.set_title('Electricity Consumption')
-    ax2.set_title('Gas Consumption')
-    
-    for ax in [ax1, ax2]:
-        ax.grid(True)
-        ax.tick_params(axis='x', rotation=45)
-        ax.legend()
-    
-    plt.tight_layout()
-    
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', dpi=300, bbox_inches='tight')
-    plt.close()
+            if dates:
+                if data.fuel_type == 'electricity':
+                    ax1.plot(dates, values, marker='o', markevery=marker_step(len(dates)), color=colors[data.fuel_type], 
+                            label=f'{data.fuel_type.capitalize()}')
+                    ax1.set_ylabel('Electricity Consumption (kWh)')
+                else:
+                    ax2.plot(dates, values, marker='o', markevery=marker_step(len(dates)), color=colors[data.fuel_type], 
+                            label=f'{data.fuel_type.capitalize()}')
+                    ax2.set_ylabel('Gas Consumption (m³)')
+        
+        ax1.set_title('Electricity Consumption')
+        ax2.set_title('Gas Consumption')
+        
+        for ax in [ax1, ax2]:
+            ax.grid(True)
+            ax.tick_params(axis='x', rotation=45)
+            ax.legend()
+        
+        combined_chart_figure.tight_layout()
+        combined_chart_figure.savefig(buf, format='png', dpi=CHART_DPI, bbox_inches='tight', pil_kwargs={'compress_level': 1})
     buf.seek(0)
     return buf
+
 @bot.tree.command(name="setup", description="Set up your Octopus Energy account")
 async def setup(interaction: discord.Interaction):
     await interaction.response.send_modal(SetupModal())
@@ -597,9 +839,28 @@ async def get_energy_data(
                 ephemeral=True
             )
 
-        session = Session()
-        user = session.query(User).filter_by(discord_id=str(interaction.user.id)).first()
-        session.close()
+        # Calculate date range excluding current day
+        to_date = datetime.now(pytz.UTC).replace(hour=0, minute=0, second=0, microsecond=0)
+        from_date = to_date - timedelta(days=int(time_period.value))
+        
+        # Adjust to_date to end of yesterday
+        to_date = to_date - timedelta(days=1)
+
+        # Readings only move once a day, so repeat requests can reuse the last reply
+        reply_key = (str(interaction.user.id), energy_type.value, time_period.value, to_date.date())
+        cached_reply = chart_cache.get(reply_key)
+        if cached_reply is not None:
+            summary_message, charts = cached_reply
+            files = [discord.File(io.BytesIO(chart), filename) for filename, chart in charts]
+            await interaction.followup.send(summary_message, files=files)
+            return
+
+        async with Session() as session:
+            # Only the credentials are needed, so skip loading the full ORM row
+            result = await session.execute(
+                user_credentials_query, {'discord_id': str(interaction.user.id)}
+            )
+            user = result.first()
 
         if not user:
             await interaction.followup.send(
@@ -609,69 +870,85 @@ async def get_energy_data(
             return
 
         try:
-            # Calculate date range excluding current day
-            to_date = datetime.now(pytz.UTC).replace(hour=0, minute=0, second=0, microsecond=0)
-            from_date = to_date - timedelta(days=int(time_period.value))
-            
-            # Adjust to_date to end of yesterday
-            to_date = to_date - timedelta(days=1)
-            
             logger.info(f"Requesting data from {from_date} to {to_date}")
 
             # Get authentication token
-            token = await get_auth_token(user.api_key)
+            token = await get_cached_auth_token(bot.gql_session, user.api_key)
             # Get account info
-            account_data = await get_account_info(token, user.account_number)
-
-            async with APIClient(token) as client:
-                tasks = []
-                properties = account_data['properties']
-
-                if energy_type.value in ['electricity', 'both']:
-                    for meter_point in properties[0].get('electricityMeterPoints', []):
-                        tasks.append(process_meter_point(client, 'electricity', meter_point, from_date, to_date))
-
-                if energy_type.value in ['gas', 'both']:
-                    for meter_point in properties[0].get('gasMeterPoints', []):
-                        tasks.append(process_meter_point(client, 'gas', meter_point, from_date, to_date))
-
-                results = await asyncio.gather(*tasks, return_exceptions=True)
-                valid_results = [r for r in results if isinstance(r, EnergyData)]
-
-                if not valid_results:
-                    error_msg = "No energy data available for the selected period. "
-                    error_msg += "Note that there is typically a delay of 1-2 days in receiving energy consumption data."
-                    await interaction.followup.send(error_msg, ephemeral=True)
-                    return
+            account_key = (hash_api_key(user.api_key), user.account_number)
+            account_data = account_cache.get(account_key)
+            if account_data is None:
+                try:
+                    account_data = await get_account_info(bot.gql_session, token, user.account_number)
+                except AuthError:
+                    # The cached token may have been revoked early; retry once with a fresh one
+                    invalidate_token(account_key[0], token)
+                    token = await get_cached_auth_token(bot.gql_session, user.api_key)
+                    account_data = await get_account_info(bot.gql_session, token, user.account_number)
+                account_cache[account_key] = account_data
+
+            client = APIClient(bot.http_client, token, account_key[0])
+            tasks = []
+            properties = account_data['properties']
+
+            # Each meter point fans out into three requests, so cap how many run at once
+            semaphore = asyncio.Semaphore(MAX_CONCURRENT_METER_POINTS)
+
+            async def gated(fuel_type, meter_point):
+                async with semaphore:
+                    return await process_meter_point(client, fuel_type, meter_point, from_date, to_date)
+
+            if energy_type.value in ['electricity', 'both']:
+                for meter_point in properties[0].get('electricityMeterPoints', []):
+                    tasks.append(gated('electricity', meter_point))
+
+            if energy_type.value in ['gas', 'both']:
+                for meter_point in properties[0].get('gasMeterPoints', []):
+                    tasks.append(gated('gas', meter_point))
+
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            valid_results = [r for r in results if isinstance(r, EnergyData)]
+
+            if not valid_results:
+                # Report a rejected token rather than claiming there is no data
+                auth_error = next((r for r in results if isinstance(r, AuthError)), None)
+                if auth_error:
+                    raise auth_error
+                error_msg = "No energy data available for the selected period. "
+                error_msg += "Note that there is typically a delay of 1-2 days in receiving energy consumption data."
+                await interaction.followup.send(error_msg, ephemeral=True)
+                return
 
-                # Send summaries with period clarification
-                period_text = "30 Days" if time_period.value == "30" else (
-                    "7 Days" if time_period.value == "7" else "90 Days"
-                )
-                summary_message = f"**Energy Summary - Last {period_text}**\n"
+            # Send summaries with period clarification
+            period_text = "30 Days" if time_period.value == "30" else (
+                "7 Days" if time_period.value == "7" else "90 Days"
+            )
+            summary_message = f"**Energy Summary - Last {period_text}**\n"
                 
-                # Add additional warning in the summary for 7-day reports
-                if time_period.value == "7":
-                    summary_message += "\n⚠️ *Note: 7-day reports may be incomplete due to meter reading delays.*\n"
+            # Add additional warning in the summary for 7-day reports
+            if time_period.value == "7":
+                summary_message += "\n⚠️ *Note: 7-day reports may be incomplete due to meter reading delays.*\n"
                 
-                for data in valid_results:
-                    if data.consumption:
-                        summary_message += f"\n**{data.fuel_type.capitalize()} Summary**\n```{data.summary}```\n"
+            for data in valid_results:
+                if data.consumption:
+                    summary_message += f"\n**{data.fuel_type.capitalize()} Summary**\n```{data.summary}```\n"
                 
-                await interaction.followup.send(summary_message)
+            # Render charts, then send them with the summary as a single message
+            if energy_type.value == "both" and len(valid_results) > 1:
+                # Render off the event loop so other commands keep being served
+                chart_buffer = await asyncio.to_thread(generate_combined_chart, valid_results)
+                charts = [("energy_consumption.png", chart_buffer.getvalue())]
+            else:
+                charts = []
+                for data in valid_results:
+                    chart_buffer = await asyncio.to_thread(generate_chart, data)
+                    charts.append((f"{data.fuel_type}_consumption.png", chart_buffer.getvalue()))
 
-                # Send charts
-                if energy_type.value == "both" and len(valid_results) > 1:
-                    chart_buffer = generate_combined_chart(valid_results)
-                    await interaction.followup.send(
-                        file=discord.File(chart_buffer, "energy_consumption.png")
-                    )
-                else:
-                    for data in valid_results:
-                        chart_buffer = generate_chart(data)
-                        await interaction.followup.send(
-                            file=discord.File(chart_buffer, f"{data.fuel_type}_consumption.png")
-                        )
+            # Don't hold on to a partial report after a transient meter point failure
+            if len(valid_results) == len(results):
+                chart_cache[reply_key] = (summary_message, charts)
+            files = [discord.File(io.BytesIO(chart), filename) for filename, chart in charts]
+            await interaction.followup.send(summary_message, files=files)
 
         except ValueError as ve:
             await interaction.followup.send(f"❌ {str(ve)}", ephemeral=True)
@@ -689,13 +966,6 @@ async def get_energy_data(
             ephemeral=True
         )
 
-    except Exception as e:
-        logger.error(f"Error in get_energy_data command: {str(e)}")
-        await interaction.followup.send(
-            "❌ An unexpected error occurred. Please try again later.",
-            ephemeral=True
-        )
-
 @bot.command()
 @commands.has_permissions(administrator=True)
 async def setup_button(ctx):
@@ -713,13 +983,24 @@ async def setup_button(ctx):
         logger.error(f"Error creating setup button: {str(e)}")
         await ctx.send("❌ An error occurred while creating the setup button.", ephemeral=True)
 
+def command_tree_hash() -> str:
+    # Hash the same payload sync() would upload so any command change is picked up
+    payload = [command.to_dict(bot.tree) for command in bot.tree.get_commands()]
+    return hashlib.sha256(orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
 @bot.event
 async def on_ready():
     logger.info(f'{bot.user} has connected to Discord!')
     
     try:
-        synced = await bot.tree.sync()
-        logger.info(f"Synced {len(synced)} command(s) on startup")
+        # Global syncs are rate limited, so only push the tree when it has changed
+        tree_hash = command_tree_hash()
+        if tree_hash != await get_setting('command_tree_hash'):
+            synced = await bot.tree.sync()
+            await set_setting('command_tree_hash', tree_hash)
+            logger.info(f"Synced {len(synced)} command(s) on startup")
+        else:
+            logger.info("Command tree unchanged, skipping sync")
     except Exception as e:
         logger.error(f"Error syncing commands: {str(e)}")
 
@@ -735,10 +1016,20 @@ async def on_ready():
     channel = bot.get_channel(SETUP_CHANNEL_ID)
     if channel:
         try:
-            # Check for existing setup message
-            async for message in channel.history(limit=100):
-                if message.author == bot.user and "set up your Octopus Energy account" in message.content:
+            # Look up the stored setup message by id rather than scanning the channel
+            message_id = await get_setting('setup_message_id')
+            if message_id:
+                try:
+                    await channel.fetch_message(int(message_id))
                     return
+                except discord.NotFound:
+                    logger.info("Stored setup message no longer exists, creating a new one")
+            else:
+                # No stored id yet (first run); adopt an existing setup message if there is one
+                async for message in channel.history(limit=100):
+                    if message.author == bot.user and "set up your Octopus Energy account" in message.content:
+                        await set_setting('setup_message_id', str(message.id))
+                        return
                     
             # Create new setup message if none exists
             view = SetupView()
@@ -747,6 +1038,7 @@ async def on_ready():
                 view=view
             )
             await message.pin()
+            await set_setting('setup_message_id', str(message.id))
             logger.info("Setup button created successfully")
         except Exception as e:
             logger.error(f"Error setting up button: {str(e)}")
@@ -777,4 +1069,13 @@ async def main():
         await bot.start(TOKEN)
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # uvloop's libuv-based event loop is faster for socket I/O; it isn't available on Windows
+    try:
+        import uvloop
+    except ImportError:
+        uvloop = None
+
+    if uvloop and sys.platform != 'win32':
+        uvloop.run(main())
+    else:
+        asyncio.run(main())